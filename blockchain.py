@@ -1,12 +1,16 @@
-from functools import reduce
-from sqlalchemy import text
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+import threading
+from requests.adapters import HTTPAdapter
+from sqlalchemy import bindparam, func, select, update
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm.exc import NoResultFound
 from time import time
-import json
+import orjson
 import requests
 
 from utility.hash_util import hash_block
+from utility.merkle_util import IncrementalMerkle
 from utility.verification import Verification
 from transaction import Transaction
 from wallet import Wallet
@@ -16,6 +20,104 @@ from peer_nodes import Node
 
 # The reward we give to miners (for creating a new block)
 MINING_REWARD = 10
+# The number of proof-of-work guesses made before the search is spread over
+# all CPU cores
+SERIAL_PROOF_ATTEMPTS = 1 << 16
+# Seconds to wait for a peer node before treating it as unreachable
+PEER_TIMEOUT = 2
+
+# Keep-alive connections to the peer nodes, shared by all broadcasts
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(pool_connections=64, pool_maxsize=64))
+# Worker threads which send the requests to the peer nodes concurrently
+_EXECUTOR = ThreadPoolExecutor(max_workers=64)
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+
+# The columns which are loaded into the sendable dicts of the local state
+_BLOCK_COLS = (Block.index, Block.previous_hash, Block.hash_of_txs,
+               Block.proof, Block.timestamp)
+_TX_COLS = (Transaction.sender, Transaction.recipient, Transaction.amount,
+            Transaction.signature, Transaction.mined, Transaction.block,
+            Transaction.time)
+_NODE_COLS = (Node.id,)
+
+# The statements which are run over and over again, built once so their
+# compiled form is reused from SQLAlchemy's statement cache
+_CHAIN_STMT = select(*_BLOCK_COLS)
+_MINED_TXS_STMT = select(*_TX_COLS).where(Transaction.mined == 1)
+_OPEN_TXS_STMT = select(*_TX_COLS).where(Transaction.mined == 0)
+_ALL_TXS_STMT = select(*_TX_COLS)
+_PEER_NODES_STMT = select(*_NODE_COLS)
+_AMOUNTS_SENT_STMT = select(Transaction.sender, func.sum(Transaction.amount))\
+    .group_by(Transaction.sender)
+_AMOUNTS_RECEIVED_STMT = select(Transaction.recipient,
+                                func.sum(Transaction.amount))\
+    .where(Transaction.mined == 1)\
+    .group_by(Transaction.recipient)
+_BLOCK_TXS_STMT = select(*_TX_COLS)\
+    .where(Transaction.block == bindparam('block_index'))
+_MINE_TXS_STMT = update(Transaction)\
+    .where(Transaction.signature.in_(bindparam('signatures', expanding=True)))\
+    .values(mined=1, block=bindparam('block_index'))\
+    .execution_options(synchronize_session=False)
+
+
+def _broadcast(url, body):
+    """Posts a JSON body to a peer node and returns the response, or None if
+    the peer node could not be reached.
+
+    Arguments:
+        :url: The URL of the peer node's endpoint.
+        :body: The already serialized JSON bytes which are sent.
+    """
+    try:
+        return _SESSION.post(url, data=body, headers=_JSON_HEADERS,
+                             timeout=PEER_TIMEOUT)
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout):
+        return None
+
+
+def _fetch_whole_chain(node_id):
+    """Gets the chain of a peer node from its /chain endpoint and returns its
+    blocks as dicts, or None if the peer node could not be reached.
+
+    Arguments:
+        :node_id: The id (URL) of the peer node.
+    """
+    url = 'http://{}/chain'.format(node_id)
+    try:
+        response = _SESSION.get(url, timeout=PEER_TIMEOUT)
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout):
+        return None
+    if not response.ok:
+        return None
+    return orjson.loads(response.content)['chain']
+
+
+def _fetch_chain(node_id):
+    """Streams the chain of a peer node and returns its blocks as dicts, or
+    None if the peer node could not be reached.
+
+    Arguments:
+        :node_id: The id (URL) of the peer node.
+    """
+    url = 'http://{}/chain/stream'.format(node_id)
+    try:
+        with _SESSION.get(url, timeout=PEER_TIMEOUT, stream=True) as response:
+            if response.status_code == 404:
+                # Peer nodes of older versions only serve the whole chain
+                return _fetch_whole_chain(node_id)
+            if not response.ok:
+                return None
+            # One block per line, parsed as the lines come in
+            return [orjson.loads(line) for line in response.iter_lines()
+                    if line]
+    except (requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+            requests.exceptions.Timeout):
+        return None
 
 
 class Blockchain:
@@ -33,89 +135,235 @@ class Blockchain:
 
         # Initializing our (empty) blockchain list
         self.__chain = []
+        # The index and hash of the last block of the chain (updated with the
+        # chain)
+        self.__last_hash_cache = None
+        # Read-only copy of the chain, rebuilt after the chain changed
+        self._chain_snapshot = None
+        # Hashes of the blocks of the (verified) local chain, so peer chains
+        # sharing them only need their new blocks verified
+        self._verified_blocks = set()
         # Unhandled transactions
         self.__open_transactions = []
+        # Merkle tree over the open transactions, extended with every new one
+        self.__open_merkle = IncrementalMerkle()
         # handled transactions
         self.__mined_transactions = []
+        # Read-only copy of the mined transactions, rebuilt after they changed
+        self._mined_snapshot = None
         self.public_key = public_key
-        self.__peer_nodes = []
+        # The ids (URLs) of the peer nodes
+        self.__peer_nodes = set()
+        # Balance of every participant, kept up to date on every write
+        self.__balances = defaultdict(float)
         self.node_id = node_id
         self.resolve_conflicts = False
+        # Guards the in-memory state (and the database writes it mirrors)
+        # against concurrent requests - not held while other nodes are called
+        self._lock = threading.RLock()
         self.load_data()
 
     # This turns the chain attribute into a property with a getter (the method
     # below) and a setter (@chain.setter)
     @property
     def chain(self):
-        return self.__chain[:]
+        if self._chain_snapshot is None:
+            self._chain_snapshot = tuple(self.__chain)
+        return self._chain_snapshot
 
     # The setter for the chain property
     @chain.setter
     def chain(self, val):
         self.__chain = val
+        self._chain_snapshot = None
+        self._verified_blocks = {hash_block(block) for block in val}
+        self.__last_hash_cache = None
+
+    @property
+    def last_hash(self):
+        """The hash of the last block of the chain (None if the chain is
+        empty), computed once per last block."""
+        if not self.__chain:
+            return None
+        last_block = self.__chain[-1]
+        if (self.__last_hash_cache is None or
+                self.__last_hash_cache[0] != last_block['index']):
+            self.__last_hash_cache = (last_block['index'],
+                                      hash_block(last_block))
+        return self.__last_hash_cache[1]
 
     @property
     def mined_transactions(self):
-        return self.__mined_transactions[:]
+        if self._mined_snapshot is None:
+            self._mined_snapshot = tuple(self.__mined_transactions)
+        return self._mined_snapshot
 
     # The setter for the non-open transactions property
     @mined_transactions.setter
     def mined_transactions(self, val):
         self.__mined_transactions = val
+        self._mined_snapshot = None
 
     def get_open_transactions(self):
         """Returns a copy of the open transactions list."""
         return self.__open_transactions[:]
 
     def load_data(self):
-        """Initialize blockchain + open transactions data from a file."""
-
-        session = Session()
-        blockchain_objects = session.query(Block).all()
-        blockchain = self.make_sendable_list(blockchain_objects)
-
-        all_mined_transactions_objects = session.query(Transaction)\
-            .filter(Transaction.mined == 1).all()
-        all_mined_transactions = self.make_sendable_list(all_mined_transactions_objects)
+        """Initialize blockchain + open transactions data from the
+        database."""
+
+        with Session() as session:
+            blockchain = [row._asdict() for row in
+                          session.execute(_CHAIN_STMT)]
+            if len(blockchain) == 0:
+                # Our starting block for the blockchain
+                genesis_block = Block(0, 'GENESIS', 'GENESIS', 100, -1)
+                session.add(genesis_block)
+                session.commit()
+                # Read back as stored (e.g. the timestamp as REAL -1.0), so
+                # its hash is the same as after a restart and on other nodes
+                blockchain = [row._asdict() for row in
+                              session.execute(_CHAIN_STMT)]
+
+            all_mined_transactions = [row._asdict() for row in
+                                      session.execute(_MINED_TXS_STMT)]
+
+            open_transactions = [row._asdict() for row in
+                                 session.execute(_OPEN_TXS_STMT)]
+
+            peer_nodes = {row.id for row in session.execute(_PEER_NODES_STMT)}
+
+            # Everything a participant sent counts (including open
+            # transactions to avoid double spending), but only mined received
+            # amounts do
+            balances = defaultdict(float)
+            for participant, amount_sent in session.execute(
+                    _AMOUNTS_SENT_STMT):
+                balances[participant] -= amount_sent
+            for participant, amount_received in session.execute(
+                    _AMOUNTS_RECEIVED_STMT):
+                balances[participant] += amount_received
 
-        session.close()
         self.chain = blockchain
         self.mined_transactions = all_mined_transactions
-
-        if len(blockchain) == 0:
-            # Our starting block for the blockchain
-            session = Session()
-            genesis_block = Block(0, 'GENESIS', 'GENESIS', 100, -1)
-            session.add(genesis_block)
-            session.commit()
-            self.chain = session.query(Block).all()
-            session.close()
-
-        session = Session()
-        open_transactions_objects = session.query(Transaction)\
-            .filter(Transaction.mined == 0).all()
-        open_transactions = self.make_sendable_list(open_transactions_objects)
         self.__open_transactions = open_transactions
-
-        peer_nodes_objects = session.query(Node).all()
-        peer_nodes = self.make_sendable_list(peer_nodes_objects)
+        self.__open_merkle = IncrementalMerkle(
+            tx['signature'] for tx in open_transactions)
         self.__peer_nodes = peer_nodes
-        session.close()
+        self.__balances = balances
+
+    def _append_block(self, dict_block):
+        """Appends a block which was just stored in the database to the local
+        chain.
+
+        Arguments:
+            :dict_block: The block as a sendable dict.
+        """
+        self.__chain.append(dict_block)
+        self._chain_snapshot = None
+        block_hash = hash_block(dict_block)
+        self.__last_hash_cache = (dict_block['index'], block_hash)
+        self._verified_blocks.add(block_hash)
+
+    def _append_open_tx(self, dict_tx):
+        """Appends a transaction which was just stored in the database to the
+        open transactions.
+
+        Arguments:
+            :dict_tx: The transaction as a sendable dict.
+        """
+        self.__open_transactions.append(dict_tx)
+        self.__open_merkle.add(dict_tx['signature'])
+        self.__balances[dict_tx['sender']] -= dict_tx['amount']
+
+    def _append_mined_tx(self, dict_tx):
+        """Appends a transaction which was stored as mined (e.g. a mining
+        reward) to the mined transactions.
+
+        Arguments:
+            :dict_tx: The transaction as a sendable dict.
+        """
+        self.__mined_transactions.append(dict_tx)
+        self._mined_snapshot = None
+        self.__balances[dict_tx['sender']] -= dict_tx['amount']
+        self.__balances[dict_tx['recipient']] += dict_tx['amount']
+
+    def _mark_mined(self, signatures, block_index):
+        """Moves the open transactions with the given signatures to the mined
+        transactions, mirroring the update of the mined and block columns.
+
+        Arguments:
+            :signatures: The signatures of the transactions which were mined.
+            :block_index: The index of the block the transactions are in.
+        """
+        signatures = set(signatures)
+        still_open = []
+        for tx in self.__open_transactions:
+            if tx['signature'] in signatures:
+                tx['mined'] = 1
+                tx['block'] = block_index
+                self.__mined_transactions.append(tx)
+                self.__balances[tx['recipient']] += tx['amount']
+            else:
+                still_open.append(tx)
+        if len(still_open) != len(self.__open_transactions):
+            self.__open_merkle = IncrementalMerkle(
+                tx['signature'] for tx in still_open)
+        self.__open_transactions = still_open
+        self._mined_snapshot = None
+
+    def _append_peer(self, node_id):
+        """Appends a peer node which was just stored in the database.
+
+        Arguments:
+            :node_id: The id (URL) of the peer node.
+        """
+        self.__peer_nodes.add(node_id)
+
+    def _remove_peer(self, node_id):
+        """Removes a peer node which was just deleted from the database.
+
+        Arguments:
+            :node_id: The id (URL) of the peer node.
+        """
+        self.__peer_nodes.discard(node_id)
+
+    def _broadcast_to_peers(self, path, payload):
+        """Posts a payload to the given endpoint of all peer nodes at once and
+        returns the responses of the peer nodes which could be reached.
+
+        Arguments:
+            :path: The endpoint of the peer nodes, e.g. 'broadcast-block'.
+            :payload: The data which is sent as JSON.
+        """
+        with self._lock:
+            urls = ['http://{}/{}'.format(node_id, path)
+                    for node_id in self.__peer_nodes]
+        # The payload is the same for every peer node, so it's serialized once
+        body = orjson.dumps(payload, default=str)
+        responses = _EXECUTOR.map(_broadcast, urls, repeat(body))
+        return [response for response in responses if response is not None]
 
     def proof_of_work(self, merkle_hash):
         """Generate a proof of work for the open transactions, the hash of the
         previous block and a random number (which is guessed until it fits)."""
-        last_block = self.__chain[-1]
-        last_hash = hash_block(last_block)
-        proof = 0
-        # Try different PoW numbers and return the first valid one
-        while not Verification.valid_proof(
-                merkle_hash, last_hash, proof):
-            proof += 1
+        last_hash = self.last_hash
+        # The transactions and the previous hash are the same for every guess,
+        # so they are hashed only once and every guess continues from a copy
+        # of that state
+        midstate = Verification.proof_midstate(merkle_hash, last_hash)
+        # Try different PoW numbers and return the first valid one. A valid
+        # one is almost always among the first numbers, which is much cheaper
+        # to check here than to start worker processes for
+        proof = Verification.find_proof(midstate, stop=SERIAL_PROOF_ATTEMPTS)
+        if proof is None:
+            proof = Verification.find_proof_parallel(
+                merkle_hash, last_hash, start=SERIAL_PROOF_ATTEMPTS)
         return proof
 
     def get_balance(self, sender=None):
-        """Calculate and return the balance for a participant.
+        """Return the balance for a participant from the balances which are
+        kept up to date on every write.
         """
         if sender is None:
             if self.public_key is None:
@@ -123,41 +371,8 @@ class Blockchain:
             participant = self.public_key
         else:
             participant = sender
-        # Fetch a list of all sent coin amounts for the given person (empty
-        # lists are returned if the person was NOT the sender)
-        # This fetches sent amounts of transactions that were already included
-        # in blocks of the blockchain
-        session = Session()
-        tx_sender = session.query(Transaction.amount)\
-            .filter(text('sender == :participant'))\
-            .params(participant=str(participant)).all()
-        session.close()
-
-        # Fetch a list of all sent coin amounts for the given person (empty
-        # lists are returned if the person was NOT the sender)
-        # This fetches sent amounts of open transactions (to avoid double
-        # spending)
-        amount_sent = reduce(lambda tx_sum, tx_amt: tx_sum + sum(tx_amt)
-        if len(tx_amt) > 0 else tx_sum + 0, tx_sender, 0)
-        # This fetches received coin amounts of transactions that were already
-        # included in blocks of the blockchain
-        # We ignore open transactions here because you shouldn't be able to
-        # spend coins before the transaction was confirmed + included in a
-        # block
-        session = Session()
-        tx_recipient = session.query(Transaction.amount)\
-            .filter(text('recipient == :participant AND mined == :mined'))\
-            .params(participant=str(participant), mined=1).all()
-        session.close()
-
-        amount_received = reduce(
-            lambda tx_sum, tx_amt: tx_sum + sum(tx_amt)
-            if len(tx_amt) > 0 else tx_sum + 0,
-            tx_recipient,
-            0
-        )
-        # Return the total balance
-        return amount_received - amount_sent
+        # Return the total balance (received in blocks minus everything sent)
+        return self.__balances.get(str(participant), 0)
 
     def get_last_blockchain_value(self):
         """ Returns the last value of the current blockchain. """
@@ -167,11 +382,10 @@ class Blockchain:
 
     def get_all_transactions(self):
         """Returns all transactions of the local blockchain"""
-        session = Session()
-        all_transactions = session.query(Transaction).all()
-        session.close()
-
-        sendable_tx = self.make_sendable_list(all_transactions)
+        with Session() as session:
+            # Only the columns are fetched, no Transaction objects are built
+            sendable_tx = [row._asdict() for row in
+                           session.execute(_ALL_TXS_STMT)]
         return sendable_tx
 
     # This function accepts two arguments.
@@ -196,245 +410,229 @@ class Blockchain:
             :time: The time when the transaction was made (generated with time())
             (default = 1.0)
         """
-        session = Session()
-        transaction = Transaction(sender, recipient, signature, amount, timed=time)
-        session.add(transaction)
-        if Verification.verify_transaction(transaction, self.get_balance):
-            session.commit()
-            session.close()
-            self.load_data()
-
-            if not is_receiving:
-                for node in self.__peer_nodes:
-                    url = 'http://{}/broadcast-transaction'.format(node['id'])
-                    try:
-                        response = requests.post(url,
-                                                 json={
-                                                     'sender': sender,
-                                                     'recipient': recipient,
-                                                     'amount': amount,
-                                                     'signature': signature,
-                                                     'time': time
-                                                 })
-                        if (response.status_code == 400 or
-                                response.status_code == 500):
-                            print('Transaction declined, needs resolving')
-                            return False
-                    except requests.exceptions.ConnectionError:
-                        continue
-            return True
-        return False
+        transaction = Transaction(sender, recipient, signature, amount,
+                                  timed=time)
+        with self._lock:
+            # Rejected transactions never reach the database
+            if not Verification.verify_transaction(transaction,
+                                                   self.get_balance):
+                return False
+            dict_tx = self.make_sendable_list([transaction])[0]
+            with Session() as session:
+                session.add(transaction)
+                session.commit()
+            self._append_open_tx(dict_tx)
+
+        if not is_receiving:
+            payload = {
+                'sender': sender,
+                'recipient': recipient,
+                'amount': amount,
+                'signature': signature,
+                'time': time
+            }
+            for response in self._broadcast_to_peers(
+                    'broadcast-transaction', payload):
+                if (response.status_code == 400 or
+                        response.status_code == 500):
+                    print('Transaction declined, needs resolving')
+                    return False
+        return True
 
     def mine_block(self):
         """Create a new block and add open transactions to it."""
         # Fetch the currently last block of the blockchain
         if self.public_key is None:
             return None
-        last_block = self.__chain[-1]
-        # Hash the last block (=> to be able to compare it to the stored hash
-        # value)
-        block_index = int(len(self.__chain))
-        print(block_index)
-        self.load_data()
-        reward_transaction = Transaction(
-            'MINING', str(self.public_key),
-            'REWARD FOR MINING BLOCK {}'.format(block_index),
-            MINING_REWARD, 1, block_index, time())
-        print("rwd tx: ", reward_transaction.block)
-        # Copy transaction instead of manipulating the original
-        # open_transactions list
-        # This ensures that if for some reason the mining should fail,
-        # we don't have the reward transaction stored in the open transactions
-        copied_transactions = self.__open_transactions[:]
-        for tx in copied_transactions:
-            if not Wallet.verify_transaction(tx):
+        with self._lock:
+            block_index = int(len(self.__chain))
+            print(block_index)
+            reward_transaction = Transaction(
+                'MINING', str(self.public_key),
+                'REWARD FOR MINING BLOCK {}'.format(block_index),
+                MINING_REWARD, 1, block_index, time())
+            print("rwd tx: ", reward_transaction.block)
+            # The signatures are checked in parallel (see Wallet.verify_batch)
+            if not Wallet.verify_batch(self.__open_transactions):
                 return None
 
-        copied_transactions.append(reward_transaction)
-
-        # add and modify the objects in the database
-        hashed_transactions = Transaction.to_merkle_tree(copied_transactions)
-        hashed_block = hash_block(last_block)
-        proof = self.proof_of_work(hashed_transactions)
-        session = Session()
-        block = Block(block_index, hashed_block,
-                      hashed_transactions, proof)
-        session.add(block)
-        session.add(reward_transaction)
-        session.commit()
-        open_txs = session.query(Transaction).filter(Transaction.mined == 0).all()
-
-        for tx in open_txs:
-            tx.block = block_index
-            tx.mined = 1
+            # Copy the Merkle tree of the open transactions instead of
+            # extending the original one
+            # This ensures that if for some reason the mining should fail,
+            # we don't have the reward transaction stored in the open
+            # transactions
+            merkle = self.__open_merkle.copy()
+            merkle.add(reward_transaction.signature)
+            # Exactly the transactions in the Merkle tree go into the block
+            hashed_signatures = [tx['signature']
+                                 for tx in self.__open_transactions]
+
+            # add and modify the objects in the database
+            hashed_transactions = merkle.root()
+            # The hash of the last block (=> to be able to compare it to the
+            # stored hash value)
+            hashed_block = self.last_hash
+            proof = self.proof_of_work(hashed_transactions)
+            with Session() as session:
+                block = Block(block_index, hashed_block,
+                              hashed_transactions, proof)
+                new_block, reward_tx = self.make_sendable_list(
+                    [block, reward_transaction])
+                session.add_all([block, reward_transaction])
+                session.flush()
+                # Include the hashed open transactions in the new block
+                session.execute(_MINE_TXS_STMT,
+                                {'signatures': hashed_signatures,
+                                 'block_index': block_index})
+                sendable_tx = [row._asdict() for row in session.execute(
+                    _BLOCK_TXS_STMT, {'block_index': block_index})]
+                session.commit()
+            mined_signatures = [tx['signature'] for tx in sendable_tx]
 
-        session.commit()
-        session.close()
+            self._append_block(new_block)
+            self._append_mined_tx(reward_tx)
+            self._mark_mined(mined_signatures, block_index)
 
-        self.load_data()
+            dict_block = dict(new_block)
 
-        session = Session()
-        converted_block = session.query(Block)\
-            .filter(Block.index == block_index).one()
-        mined_transactions = session.query(Transaction).\
-            filter(Transaction.block == block_index).all()
-        session.close()
-
-        sendable_tx = self.make_sendable_list(mined_transactions)
-
-        dict_block = converted_block.__dict__.copy()
-        del dict_block['_sa_instance_state']
-
-        for node in self.__peer_nodes:
-            url = 'http://{}/broadcast-block'.format(node['id'])
-            try:
-                response = requests.post(url, json={'block': dict_block,
-                                                    'transactions': sendable_tx})
-                if response.status_code == 400 or response.status_code == 500:
-                    print('Block declined, needs resolving')
-                if response.status_code == 409:
-                    self.resolve_conflicts = True
-            except requests.exceptions.ConnectionError:
-                continue
+        payload = {'block': dict_block, 'transactions': sendable_tx}
+        for response in self._broadcast_to_peers('broadcast-block', payload):
+            if response.status_code == 400 or response.status_code == 500:
+                print('Block declined, needs resolving')
+            if response.status_code == 409:
+                self.resolve_conflicts = True
         return block
 
     def add_block(self, block, list_of_transactions):
         """Add a block which was received via broadcasting to the local
         blockchain."""
 
-        # Validate the proof of work of the block and store the result (True
-        # or False) in a variable
-        proof_is_valid = Verification.valid_proof(
-            block['hash_of_txs'], block['previous_hash'], block['proof'])
-
-        # Check if previous_hash stored in the block is equal to the local
-        # blockchain's last block's hash and store the result in a block
-        last_block = self.__chain[-1]
-        index_of_block = block['index']
-        hashes_match = hash_block(last_block) == block['previous_hash']
-        if not proof_is_valid or not hashes_match:
-            return False
+        with self._lock:
+            # Validate the proof of work of the block and store the result
+            # (True or False) in a variable
+            proof_is_valid = Verification.valid_proof(
+                block['hash_of_txs'], block['previous_hash'], block['proof'])
+
+            # Check if previous_hash stored in the block is equal to the local
+            # blockchain's last block's hash and store the result in a block
+            index_of_block = block['index']
+            hashes_match = self.last_hash == block['previous_hash']
+            if not proof_is_valid or not hashes_match:
+                return False
+
+            with Session() as session:
+                # Create a Block object
+                converted_block = Block(
+                    index_of_block,
+                    block['previous_hash'],
+                    block['hash_of_txs'],
+                    block['proof'],
+                    block['timestamp'])
+                session.add(converted_block)
+
+                # create a Transaction object of the given mining reward
+                # transactions since this Transaction is not broadcasted
+                reward_transaction = list_of_transactions[-1]
+                reward_tx = Transaction(
+                    reward_transaction['sender'],
+                    reward_transaction['recipient'],
+                    reward_transaction['signature'],
+                    reward_transaction['amount'],
+                    1, index_of_block,
+                    reward_transaction['time'])
+                new_block, new_reward_tx = self.make_sendable_list(
+                    [converted_block, reward_tx])
+                session.add(reward_tx)
+                session.flush()
+
+                # Check which open transactions were included in the received
+                # block and update the mined and block columns (except for the
+                # last transaction in the list, that is the mining reward)
+                mined_signatures = [itx['signature']
+                                    for itx in list_of_transactions[:-1]]
+                session.execute(_MINE_TXS_STMT,
+                                {'signatures': mined_signatures,
+                                 'block_index': index_of_block})
 
-        # Create a Block object
-        session = Session()
-        converted_block = Block(
-            index_of_block,
-            block['previous_hash'],
-            block['hash_of_txs'],
-            block['proof'],
-            block['timestamp'])
-        session.add(converted_block)
-
-        # create a Transaction object of the given mining reward transactions
-        # since this Transaction is not broadcasted
-        reward_transaction = list_of_transactions[-1]
-        reward_tx = Transaction(
-            reward_transaction['sender'],
-            reward_transaction['recipient'],
-            reward_transaction['signature'],
-            reward_transaction['amount'],
-            1, index_of_block,
-            reward_transaction['time'])
-        session.add(reward_tx)
-
-        session.commit()
-        session.close()
-        self.load_data()
-
-        # Check which open transactions were included in the received block
-        # and update the mined and block columns (except for the last transaction
-        # in the list, that is the mining reward)
-        mined_transactions = []
-        session = Session()
-        for itx in list_of_transactions[:-1]:
-            try:
-                for opentx in session.query(Transaction).filter(text("signature = :sign"))\
-                        .params(sign=itx['signature']).all():
-                            mined_transactions.append(opentx)
-            except NoResultFound:
-                continue
-
-        for tx in mined_transactions:
-            tx.block = index_of_block
-            tx.mined = 1
-
-        session.commit()
-        session.close()
+                session.commit()
 
-        self.load_data()
-        return True
+            self._append_block(new_block)
+            self._append_mined_tx(new_reward_tx)
+            self._mark_mined(mined_signatures, index_of_block)
+            return True
 
     def resolve(self):
         """Checks all peer nodes' blockchains and replaces the local one with
         longer valid ones."""
-        # Initialize the winner chain with the local chain
-        winner_chain = self.chain
-        winning_node = self.node_id
-        replace = False
-        for node in self.__peer_nodes:
-            url = 'http://{}/chain'.format(node['id'])
-            try:
-                # Send a request and store the response
-                response = requests.get(url)
-                # Retrieve the JSON data as a dictionary
-                peer_node_data = response.json()
-                node_chain = peer_node_data['chain']
-                # Convert the dictionary list to a list of block AND
-                # transaction objects
-
-                node_chain = [
-                    Block(
-                        block['index'],
-                        block['previous_hash'],
-                        block['hash_of_txs'],
-                        block['proof'],
-                        block['timestamp']) for block in node_chain
-                ]
-                node_chain_length = len(node_chain)
-                local_chain_length = len(winner_chain)
-                # Store the received chain as the current winner chain if it's
-                # longer AND valid
-                if (node_chain_length > local_chain_length and
-                        Verification.verify_chain(node_chain)):
-                    winner_chain = node_chain
-                    winning_node = node['id']
-                    replace = True
-            except requests.exceptions.ConnectionError:
+        with self._lock:
+            local_chain_length = len(self.__chain)
+            node_ids = list(self.__peer_nodes)
+        # Fetch the chains of all peer nodes at once
+        candidates = []
+        for node_id, node_chain in zip(node_ids,
+                                       _EXECUTOR.map(_fetch_chain, node_ids)):
+            if node_chain is None:
                 continue
+            # Only a longer chain can replace the local one, so shorter ones
+            # are neither converted nor verified
+            if len(node_chain) > local_chain_length:
+                candidates.append((node_id, node_chain))
+
+        # Verify the longest chains first, the first valid one wins
+        candidates.sort(key=lambda candidate: len(candidate[1]), reverse=True)
+        winner_chain = None
+        winning_node = self.node_id
+        for node_id, node_chain in candidates:
+            # Only the columns of the blocks are kept, they're verified and
+            # stored as dicts (no Block objects are built)
+            node_chain = [
+                {
+                    'index': block['index'],
+                    'previous_hash': block['previous_hash'],
+                    'hash_of_txs': block['hash_of_txs'],
+                    'proof': block['proof'],
+                    'timestamp': block['timestamp']
+                } for block in node_chain
+            ]
+            if Verification.verify_chain(node_chain, self._verified_blocks):
+                winner_chain = node_chain
+                winning_node = node_id
+                break
         self.resolve_conflicts = False
+        if winner_chain is None:
+            return False
+        # get transactions from winning chain to replace the local ones
+        url = 'http://{}/gettransactions'.format(winning_node)
+        response = _SESSION.get(url, timeout=PEER_TIMEOUT)
+        transactions_object = orjson.loads(response.content)
+        transactions = transactions_object['transactions']
         # Replace the local chain with the winner chain
-        if self.chain is not winner_chain and replace:
-            # get transactions from winning chain to replace the local ones
-            url = 'http://{}/gettransactions'.format(winning_node)
-            response = requests.get(url)
-            transactions_object = response.json()
-            transactions = transactions_object['transactions']
-            session = Session()
-            # delete local content of databases
-            session.query(Transaction).delete()
-            session.query(Block).delete()
-            try:
+        with self._lock:
+            # The local chain may have grown while the peer nodes were asked
+            if len(self.__chain) >= len(winner_chain):
+                return False
+            with Session() as session:
+                # delete local content of databases and insert the winner's
+                # content in one transaction
+                session.query(Transaction).delete(synchronize_session=False)
+                session.query(Block).delete(synchronize_session=False)
+
+                session.bulk_insert_mappings(Transaction, [
+                    {
+                        'sender': tx['sender'],
+                        'recipient': tx['recipient'],
+                        'signature': tx['signature'],
+                        'amount': tx['amount'],
+                        'mined': tx['mined'],
+                        'block': tx['block'],
+                        'time': tx['time']
+                    } for tx in transactions
+                ])
+                session.bulk_insert_mappings(Block, winner_chain)
                 session.commit()
-            except NoResultFound as e:
-                print(e)
-
-            new_transactions = [
-                Transaction(
-                    tx['sender'],
-                    tx['recipient'],
-                    tx['signature'],
-                    tx['amount'],
-                    tx['mined'],
-                    tx['block'],
-                    tx['time']) for tx in transactions
-            ]
-
-            session.add_all(new_transactions)
-            session.add_all(winner_chain)
-            session.commit()
-
-        self.load_data()
-        return replace
+            # The whole chain was replaced, so the local state is reloaded
+            self.load_data()
+        return True
 
     def add_peer_node(self, node):
         """Adds a new node to the peer node set.
@@ -442,16 +640,18 @@ class Blockchain:
         Arguments:
             :node: The node URL which should be added.
         """
-        session = Session()
-        new_peer_node = Node(node)
-        session.add(new_peer_node)
-        try:
-            session.commit()
-        except IntegrityError:
-            return False
-        session.close()
-        self.load_data()
-        return True
+        with self._lock:
+            if node in self.__peer_nodes:
+                return False
+            with Session() as session:
+                new_peer_node = Node(node)
+                session.add(new_peer_node)
+                try:
+                    session.commit()
+                except IntegrityError:
+                    return False
+            self._append_peer(node)
+            return True
 
     def remove_peer_node(self, node):
         """Removes a node from the peer node set.
@@ -459,21 +659,21 @@ class Blockchain:
         Arguments:
             :node: The node URL which should be removed.
         """
-        session = Session()
-        obj = session.query(Node).filter(text("id == :node_id"))\
-            .params(node_id=node).one()
-        session.delete(obj)
-        try:
-            session.commit()
-        except NoResultFound:
-            return False
-        session.close()
-        self.load_data()
-        return True
+        with self._lock:
+            if node not in self.__peer_nodes:
+                return False
+            with Session() as session:
+                # A single DELETE on the (indexed) primary key column
+                deleted = session.query(Node).filter(Node.id == node)\
+                    .delete(synchronize_session=False)
+                session.commit()
+            self._remove_peer(node)
+            return deleted > 0
 
     def get_peer_nodes(self):
         """Return a list of all connected peer nodes."""
-        return list(self.__peer_nodes)
+        with self._lock:
+            return list(self.__peer_nodes)
 
     def get_own_node(self):
         """Return own node ID"""
@@ -483,6 +683,8 @@ class Blockchain:
     @staticmethod
     def make_sendable_list(list_of_objects):
         """Converts list of objects to list of dicts so that the list can be sent
+        (only needed for objects which were just created - data read from the
+        database is fetched as dicts right away)
 
         Arguments:
             :list_of_objects: A SQLAlchemy list of objects
@@ -490,7 +692,7 @@ class Blockchain:
         dict_list = []
         for item in list_of_objects:
             dict_item = item.__dict__.copy()
-            del dict_item['_sa_instance_state']
+            dict_item.pop('_sa_instance_state', None)
             dict_list.append(dict_item)
 
         return dict_list
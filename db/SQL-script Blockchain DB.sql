@@ -42,6 +42,10 @@ CREATE TABLE `transactions` (
     FOREIGN KEY (block) REFERENCES `blockchain` (`index`)
 );
 
+CREATE INDEX `ix_tx_sender_mined` ON `transactions` (`sender`, `mined`);
+CREATE INDEX `ix_tx_recipient_mined` ON `transactions` (`recipient`, `mined`);
+CREATE INDEX `ix_tx_mined` ON `transactions` (`mined`);
+
 CREATE TABLE `peer_nodes` (
     `id` TEXT  NOT NULL ,
     PRIMARY KEY (
@@ -1,10 +1,13 @@
+import os
+
 from flask import Flask, jsonify, request
 from flask_cors import CORS
 
 from wallet import Wallet
 from blockchain import Blockchain
+from utility.database import Session
 from utility.verification import Verification
-import sqlalchemy.orm.exc
+import orjson
 
 
 v = Verification()
@@ -12,6 +15,23 @@ app = Flask(__name__)
 CORS(app)
 
 
+def orjsonify(payload):
+    """Like jsonify, but serializes with orjson - used for the endpoints which
+    return the (possibly large) chain and transaction lists.
+
+    Arguments:
+        :payload: The data which is sent as JSON.
+    """
+    return app.response_class(orjson.dumps(payload, default=str),
+                              mimetype='application/json')
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    # Hand the connection of this request's session back to the pool
+    Session.remove()
+
+
 @app.route('/wallet', methods=['POST'])
 def create_keys():
     wallet.create_keys()
@@ -45,7 +65,8 @@ def load_keys():
 
     private_key = values['private_key']
 
-    if wallet.load_keys(private_key):
+    loaded = wallet.load_keys(private_key)
+    if loaded:
         global blockchain
         blockchain = Blockchain(wallet.public_key, port)
         response = {
@@ -54,21 +75,16 @@ def load_keys():
             'funds': blockchain.get_balance()
         }
         return jsonify(response), 201
-    elif ValueError:
+    elif loaded is None:
         response = {
             'message': 'No valid key given.'
         }
         return jsonify(response), 400
-    elif sqlalchemy.orm.exc.NoResultFound:
+    else:
         response = {
             'message': 'No wallet found for given private key.'
         }
         return jsonify(response), 404
-    else:
-        response = {
-            'message': 'Loading the keys failed.'
-        }
-        return jsonify(response), 500
 
 
 @app.route('/balance', methods=['GET'])
@@ -247,7 +263,7 @@ def resolve_conflicts():
 @app.route('/transactions', methods=['GET'])
 def get_open_transaction():
     transactions = blockchain.get_open_transactions()
-    return jsonify(transactions), 200
+    return orjsonify(transactions), 200
 
 
 @app.route('/chain', methods=['GET'])
@@ -258,7 +274,20 @@ def get_chain():
         'chain': chain_snapshot,
         'mined_transactions': mined_transactions
     }
-    return jsonify(response), 200
+    return orjsonify(response), 200
+
+
+@app.route('/chain/stream', methods=['GET'])
+def stream_chain():
+    # The blocks as newline-delimited JSON, one block per line (used by peer
+    # nodes to resolve conflicts; /chain stays for the full chain with its
+    # mined transactions)
+    chain_snapshot = blockchain.chain
+
+    def generate():
+        for block in chain_snapshot:
+            yield orjson.dumps(block, default=str) + b'\n'
+    return app.response_class(generate(), mimetype='application/x-ndjson')
 
 
 @app.route('/gettransactions', methods=['GET'])
@@ -267,7 +296,7 @@ def get_winning_chain_transactions():
     response = {
         'transactions': transactions
     }
-    return jsonify(response), 200
+    return orjsonify(response), 200
 
 
 @app.route('/getnode', methods=['GET'])
@@ -335,12 +364,31 @@ def get_nodes():
     return jsonify(response), 200
 
 
+def init_node(node_port):
+    """Sets up the wallet and blockchain of this node.
+
+    Arguments:
+        :node_port: The port the node is served on (also its node id).
+    """
+    global port, wallet, blockchain
+    port = node_port
+    wallet = Wallet(port)
+    blockchain = Blockchain(wallet.public_key, port)
+
+
 if __name__ == '__main__':
+    # Development server
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=5000)
     args = parser.parse_args()
-    port = args.port
-    wallet = Wallet(port)
-    blockchain = Blockchain(wallet.public_key, port)
-    app.run(host='0.0.0.0', port=port)
+    init_node(args.port)
+    app.run(host='0.0.0.0', port=port, threaded=True)
+elif __name__ != '__mp_main__':
+    # Served by a WSGI server, which imports the app, e.g.
+    #   PORT=5000 gunicorn -w 1 -k gthread --threads 8 -b 0.0.0.0:5000 node:app
+    # The chain lives in the memory of the process, so use one worker (with
+    # threads) per node - more workers would be separate, diverging nodes
+    # (The proof-of-work worker processes import this module as __mp_main__,
+    # they don't need a node of their own)
+    init_node(int(os.environ.get('PORT', 5000)))
@@ -1,9 +1,9 @@
 from collections import OrderedDict
 from utility.printable import Printable
-from sqlalchemy import Column, Integer, ForeignKey, Text, REAL
+from sqlalchemy import Column, Integer, ForeignKey, Index, Text, REAL
 from sqlalchemy.orm import relationship
 from utility.database import Base
-from merkletools import MerkleTools
+from utility.merkle_util import IncrementalMerkle
 from time import time
 
 
@@ -17,6 +17,12 @@ class Transaction(Printable, Base):
     """
 
     __tablename__ = 'transactions'
+    # The signature is the primary key and already indexed
+    __table_args__ = (
+        Index('ix_tx_sender_mined', 'sender', 'mined'),
+        Index('ix_tx_recipient_mined', 'recipient', 'mined'),
+        Index('ix_tx_mined', 'mined'),
+    )
     sender = Column(Text, ForeignKey('wallet.public_key'), nullable=False)
     recipient = Column(Text, ForeignKey('wallet.public_key'), nullable=False)
     amount = Column(REAL, nullable=False)
@@ -48,14 +54,11 @@ class Transaction(Printable, Base):
 
     @staticmethod
     def to_merkle_tree(list_of_transactions):
-
-        merkle_tree = MerkleTools()
+        """Returns the Merkle root over the signatures of the transactions."""
+        merkle_tree = IncrementalMerkle()
         for tx in list_of_transactions:
-            print("tx: ", type(tx))
-            print(tx)
             if isinstance(tx, Transaction):
-                merkle_tree.add_leaf(tx.signature, True)
+                merkle_tree.add(tx.signature)
             else:
-                merkle_tree.add_leaf(tx['signature'], True)
-        merkle_tree.make_tree()
-        return merkle_tree.get_merkle_root()
+                merkle_tree.add(tx['signature'])
+        return merkle_tree.root()
@@ -1,9 +1,16 @@
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.pool import QueuePool
 from sqlalchemy import create_engine
 
 
-engine = create_engine('sqlite+pysqlite:///db/blockchaindb.sqlite')
+# Keep a pool of open connections instead of opening the database file for
+# every session (a connection is only used by one thread at a time, so it
+# may be handed to another thread afterwards)
+engine = create_engine('sqlite+pysqlite:///db/blockchaindb.sqlite',
+                       poolclass=QueuePool, pool_size=10,
+                       connect_args={'check_same_thread': False})
 Base = declarative_base(bind=engine)
-Session = sessionmaker(bind=engine)
-
+# One session per thread, reused across units of work. Objects keep their
+# loaded state after a commit so they can still be read once it is closed.
+Session = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
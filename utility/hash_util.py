@@ -1,6 +1,9 @@
 import hashlib as hl
 import json
-from block import Block
+
+# hashlib uses OpenSSL's SHA256, which runs on the CPU's SHA extensions
+# (SHA-NI) where available - use a Python build linked against OpenSSL 1.1.1
+# or newer to get them.
 
 
 def hash_string_256(string):
@@ -21,12 +24,13 @@ def hash_block(blocked):
     except TypeError:
         block = blocked
 
-    index = block['index']
-    previous_hash = block['previous_hash']
-    hash_of_txs = block['hash_of_txs']
-    proof = block['proof']
-    timestamp = block['timestamp']
-
-    blocked = Block(index, previous_hash, hash_of_txs, proof, timestamp)
-    hashable_block = blocked.block_to_ordered_dict()
+    # Only the columns of the block are hashed (the keys are sorted anyway,
+    # so there's no need to build a Block and its OrderedDict first)
+    hashable_block = {
+        'index': block['index'],
+        'previous_hash': block['previous_hash'],
+        'hash_of_txs': block['hash_of_txs'],
+        'proof': block['proof'],
+        'timestamp': block['timestamp']
+    }
     return hash_string_256(json.dumps(hashable_block, sort_keys=True).encode())
@@ -0,0 +1,48 @@
+import hashlib as hl
+
+
+class IncrementalMerkle:
+    """Builds the Merkle root of a growing list of leaves without rehashing
+    the whole tree for every new leaf.
+
+    The root is the same as the one of a MerkleTools tree with hashed leaves:
+    pairs are hashed level by level and an odd node at the end of a level is
+    carried up unchanged.
+    """
+
+    def __init__(self, leaves=()):
+        # The roots of the complete subtrees built so far as (height, hash)
+        # tuples, the biggest (leftmost) one first
+        self.__peaks = []
+        for leaf in leaves:
+            self.add(leaf)
+
+    def add(self, leaf):
+        """Adds a leaf, only hashing the nodes which are completed by it.
+
+        Arguments:
+            :leaf: The (unhashed) string value of the leaf.
+        """
+        node = hl.sha256(leaf.encode('utf-8')).digest()
+        height = 0
+        while self.__peaks and self.__peaks[-1][0] == height:
+            node = hl.sha256(self.__peaks.pop()[1] + node).digest()
+            height += 1
+        self.__peaks.append((height, node))
+
+    def copy(self):
+        """Returns an independent copy which can be extended separately."""
+        merkle = IncrementalMerkle()
+        merkle.__peaks = self.__peaks[:]
+        return merkle
+
+    def root(self):
+        """Returns the hex Merkle root, or None if there are no leaves."""
+        if not self.__peaks:
+            return None
+        # Combine the subtrees from the right, which is where the levels of a
+        # full rebuild would carry up the odd nodes
+        node = self.__peaks[-1][1]
+        for _, left in reversed(self.__peaks[:-1]):
+            node = hl.sha256(left + node).digest()
+        return node.hex()
@@ -1,52 +1,174 @@
 """Provides verification helper methods."""
 
-from utility.hash_util import hash_string_256, hash_block
+from concurrent.futures import ProcessPoolExecutor
+import hashlib as hl
+from itertools import count
+import multiprocessing
+import os
+
+from utility.hash_util import hash_block
 from wallet import Wallet
 from flask import jsonify
 
+# The number of 0s a proof-of-work hash (as hex digest) has to start with
+PROOF_DIFFICULTY = 2
+# The raw digests below this one are the ones starting with PROOF_DIFFICULTY
+# hex 0s (bytes of the same length compare like the numbers they encode)
+PROOF_TARGET = (1 << (256 - 4 * PROOF_DIFFICULTY)).to_bytes(32, 'big')
+# The number of proof numbers each worker process tries per round of a
+# parallel proof-of-work search
+PROOF_SHARD_SIZE = 1 << 16
+# Worker processes are not forked from the (multi-threaded) node process -
+# forking it could copy a lock held by another thread and deadlock the worker
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    PROOF_START_METHOD = 'forkserver'
+else:
+    PROOF_START_METHOD = 'spawn'
+
+
+def _find_proof_shard(hash_of_txs, last_hash, start, stop, step):
+    """Search one shard of proof numbers in a worker process (hash states
+    can't be sent to other processes, so the midstate is rebuilt here)."""
+    return Verification.find_proof(
+        Verification.proof_midstate(hash_of_txs, last_hash), start, stop, step)
+
 
 class Verification:
     """A helper class which offer various static and class-based verification
     and validation methods."""
     @staticmethod
-    def valid_proof(hash_of_txs, last_hash, proof):
-        """Validate a proof of work number and see if it solves the puzzle
-        algorithm (two leading 0s)
+    def proof_midstate(hash_of_txs, last_hash):
+        """Absorb the part of the proof-of-work input which does not change
+        between guesses and return the resulting SHA256 state.
         Arguments:
             :hash_of_txs: The Merkleroot hash of the transactions
             of the block for which the proof is created.
             :last_hash: The previous block's hash which will be stored in the
             current block.
+        """
+        return hl.sha256((str(hash_of_txs) + str(last_hash)).encode())
+
+    @staticmethod
+    def valid_midstate_proof(midstate, proof):
+        """Validate a proof of work number against a state returned by
+        proof_midstate (the state itself is left untouched).
+        Arguments:
+            :midstate: The SHA256 state of the static proof-of-work input.
             :proof: The proof number we're testing.
         """
-        # Create a string with all the hash inputs
-        guess = (str(hash_of_txs) + str(last_hash) + str(proof)).encode()
-        # Hash the string
+        guess = midstate.copy()
+        guess.update(str(proof).encode())
         # IMPORTANT: This is NOT the same hash as will be stored in the
         # previous_hash. It's a not a block's hash. It's only used for the
         # proof-of-work algorithm.
-        guess_hash = hash_string_256(guess)
+        guess_hash = guess.digest()
         # Only a hash (which is based on the above inputs) which starts with
-        # two 0s is treated as valid
+        # PROOF_DIFFICULTY 0s is treated as valid
         # This condition is of course defined by you. You could also require
         # 10 leading 0s - this would take significantly longer (and this
         # allows you to control the speed at which new blocks can be added)
-        return guess_hash[0:2] == '00'
+        return guess_hash < PROOF_TARGET
+
+    @staticmethod
+    def find_proof(midstate, start=0, stop=None, step=1):
+        """Return the first valid proof of work number in range(start, stop,
+        step), or None if there is none (without stop the search goes on
+        until a proof is found).
+        Arguments:
+            :midstate: The SHA256 state of the static proof-of-work input (as
+            returned by proof_midstate).
+            :start: The first proof number to try.
+            :stop: The proof number at which the search gives up.
+            :step: The distance between two proof numbers which are tried.
+        """
+        if stop is None:
+            proofs = count(start, step)
+        else:
+            proofs = range(start, stop, step)
+        # This is the same check as valid_midstate_proof, inlined so a guess
+        # costs no more than copying the state, hashing the number and
+        # comparing the digest to the target
+        copy_state = midstate.copy
+        for proof in proofs:
+            guess = copy_state()
+            guess.update(b'%d' % proof)
+            if guess.digest() < PROOF_TARGET:
+                return proof
+        return None
+
+    @staticmethod
+    def find_proof_parallel(hash_of_txs, last_hash, start=0, workers=None):
+        """Return the first valid proof of work number from start on, split
+        over worker processes. Every round each worker tries every n-th number
+        of the next n * PROOF_SHARD_SIZE numbers; the smallest hit wins, so
+        the result is the same as the serial search.
+        Arguments:
+            :hash_of_txs: The Merkleroot hash of the transactions
+            of the block for which the proof is created.
+            :last_hash: The previous block's hash which will be stored in the
+            current block.
+            :start: The first proof number to try.
+            :workers: The number of worker processes (default: CPU count).
+        """
+        workers = workers or os.cpu_count() or 1
+        if workers == 1:
+            return Verification.find_proof(
+                Verification.proof_midstate(hash_of_txs, last_hash), start)
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context(PROOF_START_METHOD))\
+                as executor:
+            while True:
+                stop = start + workers * PROOF_SHARD_SIZE
+                shards = [executor.submit(_find_proof_shard, hash_of_txs,
+                                          last_hash, start + offset, stop,
+                                          workers)
+                          for offset in range(workers)]
+                proofs = [shard.result() for shard in shards]
+                proofs = [proof for proof in proofs if proof is not None]
+                if proofs:
+                    return min(proofs)
+                start = stop
 
     @classmethod
-    def verify_chain(cls, blockchain):
+    def valid_proof(cls, hash_of_txs, last_hash, proof):
+        """Validate a proof of work number and see if it solves the puzzle
+        algorithm (PROOF_DIFFICULTY leading 0s)
+        Arguments:
+            :hash_of_txs: The Merkleroot hash of the transactions
+            of the block for which the proof is created.
+            :last_hash: The previous block's hash which will be stored in the
+            current block.
+            :proof: The proof number we're testing.
+        """
+        return cls.valid_midstate_proof(
+            cls.proof_midstate(hash_of_txs, last_hash), proof)
+
+    @classmethod
+    def verify_chain(cls, blockchain, verified_hashes=()):
         """ Verify the current blockchain and return True if it's valid, False
-        otherwise."""
+        otherwise.
+        Arguments:
+            :blockchain: The blocks of the chain (as sendable dicts).
+            :verified_hashes: Hashes of blocks which were verified before
+            (e.g. the local chain); their proof of work isn't checked again.
+        """
+        last_hash = None
         for (index, block) in enumerate(blockchain):
+            # Every block is hashed once, for its successor's link check
+            block_hash = hash_block(block)
             if index == 0:
+                last_hash = block_hash
                 continue
-            if block.previous_hash != hash_block(blockchain[index - 1]):
+            if block['previous_hash'] != last_hash:
                 return False
-            if not cls.valid_proof(block.hash_of_txs,
-                                   block.previous_hash,
-                                   block.proof):
+            if (block_hash not in verified_hashes and
+                    not cls.valid_proof(block['hash_of_txs'],
+                                        block['previous_hash'],
+                                        block['proof'])):
                 print('Proof of work is invalid')
                 return False
+            last_hash = block_hash
         return True
 
     @staticmethod
@@ -55,12 +177,15 @@ class Verification:
         Arguments:
             :transaction: The transaction that should be verified.
         """
-        transaction = vars(transactions)
-        del transaction['_sa_instance_state']
+        # A copy, the state of the Transaction object itself is left intact
+        transaction = vars(transactions).copy()
+        transaction.pop('_sa_instance_state', None)
         if check_funds:
-            sender_balance = get_balance(transaction['sender'])
-            return (sender_balance >= transaction['amount'] and
-                    Wallet.verify_transaction(transaction))
+            # The signature check comes first, it also rejects fields of the
+            # wrong type (e.g. an amount which can't be compared)
+            return (Wallet.verify_transaction(transaction) and
+                    get_balance(transaction['sender']) >=
+                    transaction['amount'])
         else:
             return Wallet.verify_transaction(transaction)
 
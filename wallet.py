@@ -1,14 +1,185 @@
-from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
-from Crypto.Hash import SHA256
-import Crypto.Random
-import binascii
-from sqlalchemy import Column, Text, text, ForeignKey
-from sqlalchemy.orm.exc import NoResultFound
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.asymmetric.ed25519 import (
+    Ed25519PrivateKey, Ed25519PublicKey)
+from cryptography.hazmat.primitives.serialization import (
+    Encoding, NoEncryption, PrivateFormat, PublicFormat,
+    load_der_private_key, load_der_public_key)
+from functools import lru_cache
+from operator import itemgetter
+import os
+import threading
+from sqlalchemy import Column, Text, ForeignKey
 from sqlalchemy.orm import relationship
 from utility.database import Base, Session
 from time import time
 
+# The length of an Ed25519 key as hex string (a raw 32 byte key). Keys of
+# older wallets are hex DER encoded RSA keys, which are much longer, so the
+# length tells which scheme a key (and its signatures) belongs to.
+ED25519_KEY_LENGTH = 64
+# The number of parsed public keys which are kept, so a key which verifies
+# many transactions is only parsed once (keys are immutable hex strings)
+KEY_CACHE_SIZE = 2048
+# The number of valid transaction signatures which are remembered
+SIGNATURE_CACHE_SIZE = 1 << 16
+
+# The signed fields (and the signature) of a transaction dict, in the order
+# _verify_signature takes them - pulled out with one call per transaction
+_signed_fields = itemgetter('sender', 'recipient', 'amount', 'time',
+                            'signature')
+
+# The (signed fields, signature) of transactions whose signature was found
+# valid, oldest first. Only valid ones are kept - invalid transactions can be
+# posted by anyone, so remembering them would let anyone fill the memory.
+_valid_signatures = OrderedDict()
+_valid_signatures_lock = threading.Lock()
+
+# Threads which verify signatures in parallel (OpenSSL releases the GIL while
+# it verifies, so threads use all cores)
+_VERIFY_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+
+def _is_ed25519_key(hex_key):
+    """Returns whether a hex key is an Ed25519 key (and not an RSA key).
+
+    Arguments:
+        :hex_key: The private or public key as hex string.
+    """
+    return len(hex_key) == ED25519_KEY_LENGTH
+
+
+def _ed25519_private_hex(private_key):
+    """Returns the hex string of an Ed25519 private key.
+
+    Arguments:
+        :private_key: The Ed25519 private key object.
+    """
+    return private_key.private_bytes(
+        Encoding.Raw, PrivateFormat.Raw, NoEncryption()).hex()
+
+
+def _ed25519_public_key(private_key):
+    """Returns the Ed25519 public key (as hex string) of a private key.
+
+    Arguments:
+        :private_key: The Ed25519 private key object.
+    """
+    return private_key.public_key()\
+        .public_bytes(Encoding.Raw, PublicFormat.Raw).hex()
+
+
+def _signing_payload(sender, recipient, amount, timed):
+    """Returns the bytes which are signed for a transaction.
+
+    Arguments:
+        :sender: The sender of the transaction.
+        :recipient: The recipient of the transaction.
+        :amount: The amount of the transaction.
+        :timed: The time of the transaction.
+    """
+    # An f-string builds the string in one go (utf8 rather than ascii, so
+    # recipients with other characters still work)
+    return f'{sender}{recipient}{amount}{timed}'.encode('utf8')
+
+
+def _ed25519_private_key(hex_key):
+    """Returns the Ed25519 private key object of a hex private key.
+
+    Arguments:
+        :hex_key: The private key as hex string.
+    """
+    return Ed25519PrivateKey.from_private_bytes(bytes.fromhex(hex_key))
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _ed25519_verifier(hex_key):
+    """Returns the Ed25519 public key object of a hex public key.
+
+    Arguments:
+        :hex_key: The public key as hex string.
+    """
+    return Ed25519PublicKey.from_public_bytes(bytes.fromhex(hex_key))
+
+
+def _rsa_private_key(hex_key):
+    """Returns the RSA private key object of a hex DER private key.
+
+    Arguments:
+        :hex_key: The private key as hex string.
+    """
+    return load_der_private_key(bytes.fromhex(hex_key), password=None)
+
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def _rsa_verifier(hex_key):
+    """Returns the RSA public key object of a hex DER public key.
+
+    Arguments:
+        :hex_key: The public key as hex string.
+    """
+    return load_der_public_key(bytes.fromhex(hex_key))
+
+
+def _verify_signature(sender, recipient, amount, timed, signature):
+    """Returns whether a signature of a transaction is valid. Valid results
+    are remembered, as the same transaction is verified when it's added and
+    again when it's mined.
+
+    Arguments:
+        :sender: The sender (public key) of the transaction.
+        :recipient: The recipient of the transaction.
+        :amount: The amount of the transaction.
+        :timed: The time of the transaction.
+        :signature: The signature of the transaction as hex string.
+    """
+    # The types are part of the key, since e.g. an amount of 5 and one of 5.0
+    # are signed as different strings
+    key = (sender, recipient, amount, type(amount), timed, type(timed),
+           signature)
+    if key in _valid_signatures:
+        return True
+    payload = _signing_payload(sender, recipient, amount, timed)
+    # Malformed keys or signatures (not hex, not a key, unsupported or wrong
+    # key type) make the transaction invalid, too - the result is always a
+    # bool
+    try:
+        signature = bytes.fromhex(signature)
+        if _is_ed25519_key(sender):
+            _ed25519_verifier(sender).verify(signature, payload)
+        else:
+            # Transactions of wallets created before the switch to Ed25519
+            _rsa_verifier(sender).verify(signature, payload,
+                                         padding.PKCS1v15(), hashes.SHA256())
+    except (InvalidSignature, TypeError, UnsupportedAlgorithm, ValueError):
+        return False
+    with _valid_signatures_lock:
+        _valid_signatures[key] = None
+        if len(_valid_signatures) > SIGNATURE_CACHE_SIZE:
+            _valid_signatures.popitem(last=False)
+    return True
+
+
+def _signature_valid(fields):
+    """Returns whether the signature of a transaction is valid, checking the
+    types of its fields first (values from other nodes' JSON may be anything,
+    and e.g. lists can't be looked up among the valid signatures).
+
+    Arguments:
+        :fields: The (sender, recipient, amount, time, signature) of the
+        transaction.
+    """
+    sender, recipient, amount, timed, signature = fields
+    if not (isinstance(sender, str) and isinstance(recipient, str) and
+            isinstance(signature, str) and
+            isinstance(amount, (int, float)) and
+            isinstance(timed, (int, float))):
+        return False
+    return _verify_signature(*fields)
+
 
 class Wallet(Base):
     """Creates, loads and holds private and public keys. Manages transaction
@@ -20,73 +191,112 @@ class Wallet(Base):
 
     peer_node_id = relationship("Node", back_populates="wallet_id")
 
+    # Wallets loaded by a query don't run __init__
+    _signing_key = None
+    _node_address = None
+
     def __init__(self, node_id, private_key=None, public_key=None):
         self.private_key = private_key
         self.public_key = public_key
         self.node_id = node_id
+        # The parsed private key, so it's parsed only once per wallet
+        self._signing_key = None
 
     def create_keys(self):
         """Create a new pair of private and public keys."""
-        private_key, public_key = self.generate_keys()
-        self.private_key = private_key
-        self.public_key = public_key
+        signing_key = Ed25519PrivateKey.generate()
+        self.private_key = _ed25519_private_hex(signing_key)
+        self.public_key = _ed25519_public_key(signing_key)
+        self._signing_key = signing_key
+
+    def _get_signing_key(self):
+        """Returns the parsed private key of the wallet (parsed on first
+        use)."""
+        if self._signing_key is None:
+            if _is_ed25519_key(self.private_key):
+                self._signing_key = _ed25519_private_key(self.private_key)
+            else:
+                self._signing_key = _rsa_private_key(self.private_key)
+        return self._signing_key
 
     def save_keys(self):
         """Saves the keys to a file (wallet.txt)."""
         if self.public_key is not None and self.private_key is not None:
-            try:
-                with open('wallet-{}.txt'.format(self.node_id), mode='w') as f:
-                    f.write(self.private_key)
-                session = Session()
-                wallet = Wallet(node_id=self.node_id, public_key=self.public_key)
-                session.add(wallet)
-                session.commit()
-                session.close()
-                return True
-            except (IOError, IndexError):
-                print('Saving wallet failed...')
-                return False
+            return self.bulk_save([self])
+
+    @classmethod
+    def bulk_save(cls, wallets):
+        """Saves the keys of many wallets to their files and stores all of the
+        wallets in the database with one insert and one commit.
+
+        Arguments:
+            :wallets: The wallets (with their keys set) that should be saved.
+        """
+        # The key file is named after the node, so a second wallet of the
+        # same node would overwrite the first one's private key
+        node_ids = [wallet.node_id for wallet in wallets]
+        if len(set(node_ids)) != len(node_ids):
+            print('Saving wallet failed, one wallet per node...')
+            return False
+        try:
+            # The files are written before the database transaction starts,
+            # so the transaction doesn't wait for the disk
+            for wallet in wallets:
+                with open('wallet-{}.txt'.format(wallet.node_id),
+                          mode='w') as f:
+                    f.write(wallet.private_key)
+        except (IOError, IndexError):
+            print('Saving wallet failed...')
+            return False
+        with Session() as session:
+            session.bulk_insert_mappings(cls, [
+                {
+                    'node_id': wallet.node_id,
+                    'public_key': wallet.public_key
+                } for wallet in wallets
+            ])
+            session.commit()
+        return True
 
     def load_keys(self, private_key):
-        """Loads the wallet based on the private key."""
+        """Loads the wallet based on the private key. Returns None if the key
+        is invalid and False if no wallet exists for it."""
 
         # prepare the private_key input to be transformed to the public_key
         try:
-            hex_to_pem = binascii.unhexlify(''.join(private_key))
-            pem_key = b'%s' % hex_to_pem
-            kep_priv = RSA.importKey(pem_key)
-            candidate_key = kep_priv.publickey()
-            query_key = binascii.hexlify(candidate_key.exportKey(format='DER')).decode('ascii')
-        except ValueError as e:
-            return e
+            private_key = ''.join(private_key)
+            if _is_ed25519_key(private_key):
+                signing_key = _ed25519_private_key(private_key)
+                query_key = _ed25519_public_key(signing_key)
+            else:
+                signing_key = _rsa_private_key(private_key)
+                candidate_key = signing_key.public_key()
+                query_key = candidate_key.public_bytes(
+                    Encoding.DER, PublicFormat.SubjectPublicKeyInfo).hex()
+        except (TypeError, UnsupportedAlgorithm, ValueError):
+            return None
 
         # Pass the candidate key for the
         # SQL query and search database for the public_key
-        session = Session()
-        try:
+        with Session() as session:
             public_key = session.query(Wallet.public_key)\
-                .filter(text('public_key == :query_key')).params(query_key=query_key)\
-                .one()
-        except NoResultFound as e:
-            return e
-        session.close()
+                .filter(Wallet.public_key == query_key)\
+                .one_or_none()
+        if public_key is None:
+            return False
 
         self.public_key = ''.join(public_key)
         self.private_key = private_key
+        self._signing_key = signing_key
         return True
 
     @staticmethod
     def generate_keys():
-        """Generate a new pair of private and public key."""
-        private_key = RSA.generate(1024, Crypto.Random.new().read)
-        public_key = private_key.publickey()
+        """Generate a new pair of (Ed25519) private and public key."""
+        private_key = Ed25519PrivateKey.generate()
         return (
-            binascii
-            .hexlify(private_key.exportKey(format='DER'))
-            .decode('ascii'),
-            binascii
-            .hexlify(public_key.exportKey(format='DER'))
-            .decode('ascii')
+            _ed25519_private_hex(private_key),
+            _ed25519_public_key(private_key)
         )
 
     def sign_transaction(self, sender, recipient, amount):
@@ -98,12 +308,13 @@ class Wallet(Base):
             :amount: The amount of the transaction.
         """
         timed = time()
-        signer = PKCS1_v1_5.new(RSA.importKey(
-            binascii.unhexlify(self.private_key)))
-        h = SHA256.new((str(sender) + str(recipient) +
-                        str(amount) + str(timed)).encode('utf8'))
-        signature = signer.sign(h)
-        return binascii.hexlify(signature).decode('ascii'), timed
+        payload = _signing_payload(sender, recipient, amount, timed)
+        signer = self._get_signing_key()
+        if _is_ed25519_key(self.private_key):
+            return signer.sign(payload).hex(), timed
+        # Wallets created before the switch to Ed25519 still sign with RSA
+        signature = signer.sign(payload, padding.PKCS1v15(), hashes.SHA256())
+        return signature.hex(), timed
 
     @staticmethod
     def verify_transaction(transaction):
@@ -112,17 +323,32 @@ class Wallet(Base):
         Arguments:
             :transaction: The transaction that should be verified.
         """
-        # delete the columns which are variable
-        dict_tx = transaction.copy()
-        del dict_tx['mined']
-        del dict_tx['block']
-
-        public_key = RSA.importKey(binascii.unhexlify(dict_tx['sender']))
-        verifier = PKCS1_v1_5.new(public_key)
-        h = SHA256.new((str(dict_tx['sender']) + str(dict_tx['recipient']) +
-                        str(dict_tx['amount']) + str(dict_tx['time'])).encode('utf8'))
-        return verifier.verify(h, binascii.unhexlify(dict_tx['signature']))
+        # Only these fields are signed (mined and block change later on)
+        return _signature_valid(_signed_fields(transaction))
 
     @classmethod
-    def get_node_id(cls):
-        return 'localhost:' + str(cls.node_id)
+    def verify_batch(cls, transactions):
+        """Verify the signatures of many transactions in parallel and return
+        whether all of them are valid (stops at the first invalid one).
+
+        Arguments:
+            :transactions: The transactions (as sendable dicts) that should be
+            verified.
+        """
+        # The fields are pulled out of all transactions first, the workers
+        # only get the (sender, recipient, amount, time, signature) columns
+        futures = [_VERIFY_EXECUTOR.submit(_signature_valid, fields)
+                   for fields in map(_signed_fields, transactions)]
+        for future in as_completed(futures):
+            if not future.result():
+                # The verifications which didn't start yet are not needed
+                for pending in futures:
+                    pending.cancel()
+                return False
+        return True
+
+    def get_node_id(self):
+        """Returns the address of the wallet's node (built once)."""
+        if self._node_address is None:
+            self._node_address = f'localhost:{self.node_id}'
+        return self._node_address